@@ -12,19 +12,27 @@ Env vars:
   TELEGRAM_DISCORD_WEBHOOK_URL
   TELEGRAM_CHANNEL_URL
   DISCORD_MAX_FILE_BYTES (optional, default 8MB)
+  DISCORD_MAX_RETRY_DELAY (optional, default 30 seconds)
 """
 
 import io
 import os
+import re
 import json
 import logging
 import asyncio
-from typing import Optional, Tuple, List, Any
+from bisect import bisect_left
+from typing import Optional, Tuple, List, Any, BinaryIO
 
 import httpx
 from telegram import Update
 from telegram.ext import Application, ContextTypes, MessageHandler, filters
 
+try:
+    import uvloop
+except ImportError:  # not available on Windows; the stdlib event loop is used instead
+    uvloop = None
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
@@ -38,187 +46,284 @@ TELEGRAM_CHANNEL_URL = os.getenv("TELEGRAM_CHANNEL_URL")
 # Conservative default (8MB). Can be higher on boosted servers.
 DISCORD_MAX_FILE_BYTES = int(os.getenv("DISCORD_MAX_FILE_BYTES", str(8 * 1024 * 1024)))
 
-http_client: httpx.AsyncClient | None = None
+# Longest Discord-requested wait we sit out before retrying. Updates are handled one at a
+# time, so a longer wait would stall every later channel post; the post is given up instead.
+DISCORD_MAX_RETRY_DELAY = float(os.getenv("DISCORD_MAX_RETRY_DELAY", "30"))
+
+# Branded Telegram subscribe link (Markdown, wrapped in <...> to prevent Discord embed)
+_SUBSCRIBE_SUFFIX = (
+    f"\n\n[Concordium News — subscribe](<{TELEGRAM_CHANNEL_URL}>)" if TELEGRAM_CHANNEL_URL else ""
+)
+
+# Reused for every webhook payload; compact and UTF-8 (no \uXXXX escapes)
+_json_encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+async def open_http_client(app: Application) -> None:
+    # Created before the first update is handled, shared by all handlers via bot_data.
+    # Keeps a warm (HTTP/2) connection to the webhook host between posts.
+    # "webhook_reset_at" is the event-loop time at which Discord said the webhook's
+    # rate-limit bucket refills.
+    app.bot_data["webhook_reset_at"] = 0.0
+    app.bot_data["http"] = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=4,
+            max_connections=8,
+            keepalive_expiry=60.0,
+        ),
+        headers={"User-Agent": "concordium-news-webhooks/telegram-bridge"},
+    )
+
+
+def _discord_retry_after(response: httpx.Response) -> Optional[float]:
+    """
+    Seconds Discord asks us to wait after a 429, or None if it didn't say.
+    The JSON body's retry_after is the most precise; headers are the fallback.
+    """
+    try:
+        retry_after = response.json().get("retry_after")
+        if retry_after is not None:
+            return float(retry_after)
+    except (ValueError, TypeError, AttributeError):
+        pass
+
+    for header in ("X-RateLimit-Reset-After", "Retry-After"):
+        value = response.headers.get(header)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
 
 
-async def get_http_client() -> httpx.AsyncClient:
-    global http_client
-    if http_client is None:
-        http_client = httpx.AsyncClient(timeout=30)
-    return http_client
+def _track_discord_rate_limit(bot_data: dict, response: httpx.Response) -> None:
+    """
+    Remember when the webhook's rate-limit bucket refills if Discord reports it empty,
+    so the next post waits instead of provoking a 429 (capped at DISCORD_MAX_RETRY_DELAY).
+    """
+    if response.headers.get("X-RateLimit-Remaining") != "0":
+        return
+    try:
+        reset_after = float(response.headers.get("X-RateLimit-Reset-After", ""))
+    except ValueError:
+        return
+    reset_after = min(reset_after, DISCORD_MAX_RETRY_DELAY)
+    bot_data["webhook_reset_at"] = asyncio.get_running_loop().time() + reset_after
 
 
-async def post_to_discord_webhook(client: httpx.AsyncClient, **kwargs) -> httpx.Response:
+async def post_to_discord_webhook(bot_data: dict, **kwargs) -> httpx.Response:
+    client: httpx.AsyncClient = bot_data["http"]
+    loop = asyncio.get_running_loop()
     for attempt in range(3):
+        delay: Optional[float] = None
+
+        wait = bot_data["webhook_reset_at"] - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
         try:
             r = await client.post(TELEGRAM_DISCORD_WEBHOOK_URL, **kwargs)
             r.raise_for_status()
-            return r
         except httpx.HTTPStatusError as e:
             status = e.response.status_code
             # Retry on rate limit or server errors only
             if status != 429 and status < 500:
                 raise
+            if status == 429:
+                delay = _discord_retry_after(e.response)
+                if delay is not None and delay > DISCORD_MAX_RETRY_DELAY:
+                    # e.g. a Cloudflare ban: give up on this post, and don't record its
+                    # bucket reset either, so later posts aren't held behind it
+                    raise
+            _track_discord_rate_limit(bot_data, e.response)
             if attempt == 2:
                 raise
         except httpx.RequestError:
             if attempt == 2:
                 raise
+        else:
+            _track_discord_rate_limit(bot_data, r)
+            return r
 
-        await asyncio.sleep(2 ** attempt)
+        await asyncio.sleep(delay if delay is not None else 2 ** attempt)
 
 
-async def close_http_client(_: Application) -> None:
-    global http_client
-    if http_client is not None:
-        await http_client.aclose()
-        http_client = None
+async def send_discord_message(
+    bot_data: dict,
+    payload: dict,
+    file: Optional[Tuple[str, BinaryIO, str]] = None,
+) -> None:
+    """
+    Post payload (optionally with one attached file) to the Discord webhook,
+    with failures turned into a RuntimeError carrying Discord's status and response body.
+    """
+    if file is None:
+        kwargs = {"content": _json_encode(payload), "headers": _JSON_HEADERS}
+    else:
+        # Multipart upload: the JSON payload travels as a form field
+        kwargs = {"data": {"payload_json": _json_encode(payload)}, "files": {"files[0]": file}}
+
+    try:
+        await post_to_discord_webhook(bot_data, **kwargs)
+    except httpx.RequestError as e:
+        raise RuntimeError(f"Discord webhook request error: {e}") from e
+    except httpx.HTTPStatusError as e:
+        raise RuntimeError(
+            f"Discord webhook error: {e.response.status_code} {e.response.text}"
+        ) from e
 
 
-def _utf16_offset_to_py_index(s: str, utf16_offset: int) -> int:
+async def download_telegram_file(client: httpx.AsyncClient, url: str, out: BinaryIO) -> bool:
+    """
+    Stream a Telegram file into out, giving up once it exceeds DISCORD_MAX_FILE_BYTES.
+    Returns False if the file is too large (out then holds a partial download).
+    """
+    total = 0
+    async with client.stream("GET", url) as r:
+        if r.is_error:
+            # Don't let the exception text leak the bot token embedded in the URL
+            raise RuntimeError(f"Telegram file download error: {r.status_code}")
+        async for chunk in r.aiter_bytes(64 * 1024):
+            total += len(chunk)
+            if total > DISCORD_MAX_FILE_BYTES:
+                return False
+            out.write(chunk)
+    return True
+
+
+async def close_http_client(app: Application) -> None:
+    client = app.bot_data.pop("http", None)
+    if client is not None:
+        await client.aclose()
+
+
+# Telegram entity type -> (open, close) markers
+_FMT_MARKERS = {
+    "bold": ("**", "**"),
+    "italic": ("*", "*"),
+    "underline": ("__", "__"),
+    "strikethrough": ("~~", "~~"),
+    "code": ("`", "`"),
+}
+
+_SUPPORTED_ENTITY_TYPES = frozenset(_FMT_MARKERS) | {"text_link", "pre"}
+
+# Characters outside the BMP take two UTF-16 code units (a surrogate pair)
+_ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")
+
+# Priorities for deterministic nesting when multiple markers start/end at same position.
+# Open: outer first. Close: inner first.
+# (This keeps patterns like **[text](url)** correct.)
+_OPEN_PRIORITY = {
+    "pre": 0,
+    "bold": 1,
+    "italic": 2,
+    "underline": 3,
+    "strikethrough": 4,
+    "code": 5,
+    "text_link": 10,
+}
+_CLOSE_PRIORITY = {
+    "text_link": 1,
+    "code": 5,
+    "strikethrough": 6,
+    "underline": 7,
+    "italic": 8,
+    "bold": 9,
+    "pre": 20,
+}
+
+
+def _utf16_astral_offsets(s: str) -> List[int]:
     """
     Telegram entity offsets are in UTF-16 code units.
-    Convert a UTF-16 offset to a Python string index.
+    Return the (sorted) UTF-16 offsets of the astral characters in s, i.e. the
+    characters encoded as a surrogate pair. A UTF-16 offset u maps to the
+    Python index u - bisect_left(offsets, u) (an offset inside a surrogate pair
+    maps to that character).
     """
-    if utf16_offset <= 0:
-        return 0
-
-    count = 0
-    for i, ch in enumerate(s):
-        count += 2 if ord(ch) > 0xFFFF else 1
-        if count > utf16_offset:
-            return i
-        if count == utf16_offset:
-            return i + 1
-    return len(s)
+    if s.isascii():
+        # O(1) in CPython (flag on the string object): skips the scan entirely
+        return []
+    return [m.start() + k for k, m in enumerate(_ASTRAL_RE.finditer(s))]
 
 
 def _apply_telegram_entities_to_discord_markdown(text: str, entities: List[Any]) -> str:
     """
     Convert Telegram message entities to Discord-friendly Markdown.
     Supports: text_link, bold, italic, underline, strikethrough, code, pre.
-    Telegram offsets are in UTF-16 code units -> converted via _utf16_offset_to_py_index.
+    Telegram offsets are in UTF-16 code units -> converted via _utf16_astral_offsets.
     """
     if not text or not entities:
         return text
 
-    # Telegram entity type -> (open, close) markers
-    fmt_markers = {
-        "bold": ("**", "**"),
-        "italic": ("*", "*"),
-        "underline": ("__", "__"),
-        "strikethrough": ("~~", "~~"),
-        "code": ("`", "`"),
-    }
-
-    supported = set(fmt_markers.keys()) | {"text_link", "pre"}
-    ents = [e for e in entities if getattr(e, "type", None) in supported]
-    if not ents:
+    # Most posts only carry unsupported entities (mentions, hashtags, ...): bail out
+    # before building the filtered list.
+    if not any(e.type in _SUPPORTED_ENTITY_TYPES for e in entities):
         return text
 
-    opens: dict[int, List[str]] = {}
-    closes: dict[int, List[str]] = {}
-
-    def add_open(i: int, s: str) -> None:
-        opens.setdefault(i, []).append(s)
-
-    def add_close(i: int, s: str) -> None:
-        closes.setdefault(i, []).append(s)
-
-    # Priorities for deterministic nesting when multiple markers start/end at same position.
-    # Open: outer first. Close: inner first.
-    # (This keeps patterns like **[text](url)** correct.)
-    open_priority = {
-        "pre": 0,
-        "bold": 1,
-        "italic": 2,
-        "underline": 3,
-        "strikethrough": 4,
-        "code": 5,
-        "text_link": 10,
-    }
-    close_priority = {
-        "text_link": 1,
-        "code": 5,
-        "strikethrough": 6,
-        "underline": 7,
-        "italic": 8,
-        "bold": 9,
-        "pre": 20,
-    }
-
-    # Build marker maps based on the ORIGINAL text (important for UTF-16 offsets).
+    ents = [e for e in entities if e.type in _SUPPORTED_ENTITY_TYPES]
+
+    # Marker events as (position, kind, priority, sequence, marker); kind 0 = close,
+    # 1 = open, so that at the same position closes are emitted before opens.
+    events: List[Tuple[int, int, int, int, str]] = []
+
+    # Build marker events based on the ORIGINAL text (important for UTF-16 offsets).
+    # BMP-only text (no astral chars) is the common case: UTF-16 offsets already
+    # are Python indices and astral_offsets is empty.
+    astral_offsets = _utf16_astral_offsets(text)
+    last = len(text) + len(astral_offsets)
+
     for e in ents:
-        etype = getattr(e, "type", None)
-        off = getattr(e, "offset", None)
-        ln = getattr(e, "length", None)
-        if off is None or ln is None:
-            continue
+        etype = e.type
+        off = e.offset
+        ln = e.length
 
-        start = _utf16_offset_to_py_index(text, off)
-        end = _utf16_offset_to_py_index(text, off + ln)
+        start = max(0, min(off, last))
+        end = max(0, min(off + ln, last))
+        if astral_offsets:
+            start -= bisect_left(astral_offsets, start)
+            end -= bisect_left(astral_offsets, end)
 
         if start < 0 or end < 0 or start >= end or end > len(text):
             continue
 
         if etype == "text_link":
-            url = getattr(e, "url", None)
+            url = e.url
             if not url:
                 continue
-            add_open(start, "[")
-            add_close(end, f"]({url})")
+            events.append((start, 1, _OPEN_PRIORITY["text_link"], len(events), "["))
+            events.append((end, 0, _CLOSE_PRIORITY["text_link"], len(events), f"]({url})"))
             continue
 
         if etype == "pre":
             # Telegram "pre" can have optional language
-            lang = getattr(e, "language", None)
-            if lang:
-                add_open(start, f"```{lang}\n")
-            else:
-                add_open(start, "```\n")
-            add_close(end, "\n```")
+            lang = e.language
+            op = f"```{lang}\n" if lang else "```\n"
+            events.append((start, 1, _OPEN_PRIORITY["pre"], len(events), op))
+            events.append((end, 0, _CLOSE_PRIORITY["pre"], len(events), "\n```"))
             continue
 
-        if etype in fmt_markers:
-            op, cl = fmt_markers[etype]
-            add_open(start, op)
-            add_close(end, cl)
-
-    def marker_type_open(s: str) -> str:
-        if s == "[":
-            return "text_link"
-        if s.startswith("```"):
-            return "pre"
-        for k, (op, _) in fmt_markers.items():
-            if s == op:
-                return k
-        return "bold"
-
-    def marker_type_close(s: str) -> str:
-        if s.startswith("]("):
-            return "text_link"
-        if s == "\n```":
-            return "pre"
-        for k, (_, cl) in fmt_markers.items():
-            if s == cl:
-                return k
-        return "bold"
-
-    for i in opens:
-        opens[i].sort(key=lambda s: open_priority.get(marker_type_open(s), 100))
-    for i in closes:
-        closes[i].sort(key=lambda s: close_priority.get(marker_type_close(s), 100))
-
-    # Build output in one pass:
-    # close markers first, then open markers, then the character.
+        if etype in _FMT_MARKERS:
+            op, cl = _FMT_MARKERS[etype]
+            events.append((start, 1, _OPEN_PRIORITY[etype], len(events), op))
+            events.append((end, 0, _CLOSE_PRIORITY[etype], len(events), cl))
+
+    # Sort once; the sequence number keeps equal-priority markers in entity order
+    # (and means the marker strings themselves are never compared).
+    events.sort()
+
     out: List[str] = []
-    for i in range(len(text) + 1):
-        if i in closes:
-            out.extend(closes[i])
-        if i in opens:
-            out.extend(opens[i])
-        if i < len(text):
-            out.append(text[i])
+    cursor = 0
+    for pos, _, _, _, marker in events:
+        out.append(text[cursor:pos])
+        out.append(marker)
+        cursor = pos
+    out.append(text[cursor:])
 
     return "".join(out)
 
@@ -226,20 +331,30 @@ def _apply_telegram_entities_to_discord_markdown(text: str, entities: List[Any])
 def build_discord_content(update: Update) -> str:
     msg = update.effective_message
 
-    raw_text = msg.text or msg.caption or ""
-    if not raw_text:
-        raw_text = "(media-only post)"
-
-    entities = msg.entities if msg.text else msg.caption_entities
-    text = _apply_telegram_entities_to_discord_markdown(raw_text, entities or [])
-
-    lines = [text]
-
-    # Branded Telegram subscribe link (Markdown, wrapped in <...> to prevent Discord embed)
-    if TELEGRAM_CHANNEL_URL:
-        lines.append(f"\n[Concordium News — subscribe](<{TELEGRAM_CHANNEL_URL}>)")
-
-    return "\n".join(lines)
+    if msg.text:
+        raw_text, entities = msg.text, msg.entities
+    elif msg.caption:
+        raw_text, entities = msg.caption, msg.caption_entities
+    else:
+        raw_text, entities = "(media-only post)", ()
+
+    text = _apply_telegram_entities_to_discord_markdown(raw_text, entities)
+
+    return text + _SUBSCRIBE_SUFFIX
+
+
+# Message media attribute -> (fallback filename formatted with message_id, has file_name),
+# in lookup order. Animations also carry a document, so animation must come before document.
+_MEDIA_ORDER = (
+    ("photo", "photo_{}.jpg", False),
+    ("video", "video_{}.mp4", True),
+    ("animation", "animation_{}.mp4", True),
+    ("document", "document_{}", True),
+    ("audio", "audio_{}.mp3", True),
+    ("voice", "voice_{}.ogg", False),
+    ("video_note", "video_note_{}.mp4", False),
+    ("sticker", "sticker_{}.webp", False),
+)
 
 
 def pick_telegram_media(update: Update) -> Optional[Tuple[str, str, Optional[int]]]:
@@ -251,45 +366,19 @@ def pick_telegram_media(update: Update) -> Optional[Tuple[str, str, Optional[int
     if not msg:
         return None
 
-    if msg.photo:
-        photo = msg.photo[-1]
-        return (photo.file_id, f"photo_{msg.message_id}.jpg", getattr(photo, "file_size", None))
-
-    if msg.video:
-        v = msg.video
-        return (
-            v.file_id,
-            getattr(v, "file_name", None) or f"video_{msg.message_id}.mp4",
-            getattr(v, "file_size", None),
-        )
-
-    if msg.animation:
-        a = msg.animation
-        name = getattr(a, "file_name", None) or f"animation_{msg.message_id}.mp4"
-        return (a.file_id, name, getattr(a, "file_size", None))
-
-    if msg.document:
-        d = msg.document
-        name = getattr(d, "file_name", None) or f"document_{msg.message_id}"
-        return (d.file_id, name, getattr(d, "file_size", None))
-
-    if msg.audio:
-        a = msg.audio
-        name = getattr(a, "file_name", None) or f"audio_{msg.message_id}.mp3"
-        return (a.file_id, name, getattr(a, "file_size", None))
-
-    if msg.voice:
-        v = msg.voice
-        return (v.file_id, f"voice_{msg.message_id}.ogg", getattr(v, "file_size", None))
-
-    if msg.video_note:
-        vn = msg.video_note
-        return (vn.file_id, f"video_note_{msg.message_id}.mp4", getattr(vn, "file_size", None))
-
-    if msg.sticker:
-        s = msg.sticker
-        ext = "webm" if getattr(s, "is_video", False) else "webp"
-        return (s.file_id, f"sticker_{msg.message_id}.{ext}", getattr(s, "file_size", None))
+    for attr, fallback_name, has_file_name in _MEDIA_ORDER:
+        media = getattr(msg, attr)
+        if not media:
+            continue
+
+        if attr == "photo":
+            # Largest available size
+            media = media[-1]
+        elif attr == "sticker" and media.is_video:
+            fallback_name = "sticker_{}.webm"
+
+        name = media.file_name if has_file_name else None
+        return (media.file_id, name or fallback_name.format(msg.message_id), media.file_size)
 
     return None
 
@@ -301,18 +390,12 @@ async def send_to_discord(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     content = build_discord_content(update)
     media = pick_telegram_media(update)
 
-    client = await get_http_client()
+    bot_data = context.application.bot_data
+    client: httpx.AsyncClient = bot_data["http"]
 
     # No media: send plain message
     if not media:
-        try:
-            await post_to_discord_webhook(client, json={"content": content})
-        except httpx.RequestError as e:
-            raise RuntimeError(f"Discord webhook request error: {e}") from e
-        except httpx.HTTPStatusError as e:
-            raise RuntimeError(
-                f"Discord webhook error: {e.response.status_code} {e.response.text}"
-            ) from e
+        await send_discord_message(bot_data, {"content": content})
         return
 
     file_id, filename, file_size = media
@@ -320,37 +403,27 @@ async def send_to_discord(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # If Telegram gave size and it's above Discord limit: send text only with a note
     if file_size is not None and file_size > DISCORD_MAX_FILE_BYTES:
         note = f"\n\n*(Media skipped: {file_size} bytes > Discord limit {DISCORD_MAX_FILE_BYTES} bytes)*"
-        try:
-            await post_to_discord_webhook(client, json={"content": content + note})
-        except httpx.RequestError as e:
-            raise RuntimeError(f"Discord webhook request error: {e}") from e
-        except httpx.HTTPStatusError as e:
-            raise RuntimeError(
-                f"Discord webhook error: {e.response.status_code} {e.response.text}"
-            ) from e
+        await send_discord_message(bot_data, {"content": content + note})
         return
 
-    # Download file from Telegram into memory
+    # Download file from Telegram into memory (bounded by DISCORD_MAX_FILE_BYTES)
     tg_file = await context.bot.get_file(file_id)
     buf = io.BytesIO()
-    await tg_file.download_to_memory(out=buf)
-    buf.seek(0)
+    # Telegram doesn't always report file_size: stop as soon as the limit is crossed
+    if not await download_telegram_file(client, tg_file.file_path, buf):
+        note = f"\n\n*(Media skipped: larger than Discord limit {DISCORD_MAX_FILE_BYTES} bytes)*"
+        await send_discord_message(bot_data, {"content": content + note})
+        return
 
-    # Discord webhook multipart upload
-    payload_json = {"content": content}
+    buf.seek(0)
 
-    try:
-        await post_to_discord_webhook(
-            client,
-            data={"payload_json": json.dumps(payload_json)},
-            files={"files[0]": (filename, buf.getvalue())},
-        )
-    except httpx.RequestError as e:
-        raise RuntimeError(f"Discord webhook request error: {e}") from e
-    except httpx.HTTPStatusError as e:
-        raise RuntimeError(
-            f"Discord webhook error: {e.response.status_code} {e.response.text}"
-        ) from e
+    # Discord webhook multipart upload. httpx reads the BytesIO in chunks (no full copy);
+    # BytesIO has no fileno(), so the part length comes from tell()/seek().
+    await send_discord_message(
+        bot_data,
+        {"content": content},
+        file=(filename, buf, "application/octet-stream"),
+    )
 
 
 async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -370,6 +443,7 @@ def main() -> None:
     app = (
         Application.builder()
         .token(TG_BOT_TOKEN)
+        .post_init(open_http_client)
         .post_shutdown(close_http_client)
         .build()
     )
@@ -377,6 +451,11 @@ def main() -> None:
     # Listen only to channel posts
     app.add_handler(MessageHandler(filters.ChatType.CHANNEL, handle_channel_post))
 
+    if uvloop is not None:
+        # Faster drop-in event loop. run_polling uses asyncio.get_event_loop(), which then
+        # returns this loop (uvloop's policy would refuse to create one and crash startup).
+        asyncio.set_event_loop(uvloop.new_event_loop())
+
     log.info("Telegram bridge started. Forwarding channel posts to Discord...")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 